@@ -4,7 +4,7 @@
 import time
 
 from fabric.api import *
-from boto.ec2.connection import EC2Connection
+from ec2_throttle import ThrottledEC2Connection
 
 sys.path.append('/etc')
 from lightboxkeys import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
@@ -183,7 +183,8 @@ def connect_aws():
     """
     global conn
     if conn is None:
-        conn = EC2Connection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+        conn = ThrottledEC2Connection(AWS_ACCESS_KEY_ID,
+                                      AWS_SECRET_ACCESS_KEY)
     return conn
 
 def wait_for_aws(volume, wait_on_status):
@@ -6,11 +6,12 @@ import re
 import time
 import json
 import syslog
+import threading
 import traceback
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from fabric.api import *
-from boto.ec2.connection import EC2Connection
+from ec2_throttle import ThrottledEC2Connection, format_metrics
 
 import smtplib
 from email.mime.text import MIMEText
@@ -21,7 +22,11 @@ _js = json.load(open("/home/backupbot/fabric.json"))
 ###########
 # DB Slave backup settings
 BACKUP_SERVER_INSTANCE = '' # backup server instance id
-LIVE_MYSQL_VOLUME_ID = '' # MySQL slave volume ID
+LIVE_MYSQL_VOLUME_ID = '' # MySQL slave volume ID, if not striped
+LIVE_MYSQL_VOLUME_IDS = [] # MySQL slave volume IDs, all members of a stripe
+# MySQL slave hostname, frozen while snapshotting. Required for a stripe
+LIVE_MYSQL_HOST = ''
+LIVE_MYSQL_MOUNT = '/home/volume' # MySQL slave data mount point
 BACKUPBOT_PASSWORD = _js['backupbot_password']
 
 INNODB_ROLLBACK_STR = "InnoDB: Rolling back trx with id"
@@ -40,21 +45,43 @@ TMP_SNAPSHOT_DESCR = "Temporary snapshot of db_slave for backup"
 GOOD_SNAPSHOT_DESCR = "Backupbot - db_slave: "
 MOUNT_POINT = "/dev/sdk"
 MOUNT_DEVICE = "/dev/sdk1"
+# A restored stripe attaches one volume per mount point. Members are
+# partitioned like a single volume, and the array is assembled from the
+# first partition of each (/dev/sdk1, /dev/sdl1, ...)
+MOUNT_POINTS = ["/dev/sdk", "/dev/sdl", "/dev/sdm", "/dev/sdn"]
+RAID_DEVICE = "/dev/md0"
 
 ###########
 # Logs backup settings
-LOGS_VOLUME_ID = "" # logs volume id
+LOGS_VOLUME_ID = "" # logs volume id, if not striped
+LOGS_VOLUME_IDS = [] # logs volume ids, all members of a stripe
+LOGS_MOUNT = "/home/volume" # logs mount point, frozen while snapshotting
 LOGS_FILE_PATH = "/home/volume/log/nginx-access*.log"
 
-# regex matches time in logs e.g: [26/Aug/2011:14:30:15 +0000]
-# and returns 26/Aug/2011:14:30:15 in the first group
-LOGS_TIME_REGEX = "\[(\\d+/[a-zA-Z]+/\\d+.*?:\\d+:\\d+:\\d+).*?\]"
-#extract the time from string
-LOGS_TIME_STR = "%d/%b/%Y:%H:%M:%S"
+LOGS_TAIL_BYTES = 8192 # only the final block of each log file is read
+
+# regex matches $time_local, the fourth field of a combined format log line
+# e.g: 1.2.3.4 - - [26/Aug/2011:14:30:15 +0000]
+# and returns each field, including the utc offset, in its own group
+LOGS_TIME_REGEX = re.compile(r"^\S+ \S+ \S+ \[(\d{2})/([A-Za-z]{3})/(\d{4}):"
+                             r"(\d{2}):(\d{2}):(\d{2}) ([+-])(\d{2})(\d{2})\]")
+LOGS_MONTHS = dict((month, i + 1) for i, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+# tail -v prints this header before each file
+LOGS_HEADER_REGEX = re.compile(r"^==> (.*) <==$")
 MAX_LOGS_DELAY = 300 # last log update must be within this (seconds)
+LOGS_CLOCK_SKEW = 60 # time stamps further than this in the future are ignored
 LOGS_SNAPSHOT_PREFIX = "Backupbot - logs: "
 LOGS_HOST = '' # logs hostname
 
+###########
+# Snapshot progress settings
+SNAPSHOT_POLL_INTERVAL = 15 # Seconds between snapshot progress polls
+FREEZE_TIMEOUT = 15 # Seconds a group may stay frozen while issuing snapshots
+SNAPSHOT_STALL_TIMEOUT = 1800 # Fail if progress doesn't move within this (seconds)
+MIN_THROUGHPUT_ELAPSED = 60 # Too little elapsed (seconds) to report throughput
+
 ###########
 # General settings
 EMAIL_TO = "sysadmin@FIXME" # Add sysadmin email address
@@ -95,10 +122,14 @@ def do_backup():
                 'syslog': syslog_output,
         }
     try:
-        conn = EC2Connection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+        conn = ThrottledEC2Connection(AWS_ACCESS_KEY_ID,
+                                      AWS_SECRET_ACCESS_KEY)
         conn.stop_instances([BACKUP_SERVER_INSTANCE])
     except:
-        pass
+        log(syslog.LOG_ERR, "Failed to stop backup server: %s" %
+            traceback.format_exc())
+        slave_details['stop_error'] = traceback.format_exc()
+        slave_details['syslog'] = syslog_output
 
     # reset syslog capture
     syslog_output = ""
@@ -125,9 +156,9 @@ def run_slave_backup():
     """Backup strategy:
 
     Turn on test server
-    Take a snapshot of db_slave
-    Create a volume from snapshot
-    Connect volume to test server
+    Take a snapshot of db_slave (every volume in its stripe, as a group)
+    Create a volume from each snapshot
+    Connect volumes to test server, assembling the stripe if needed
     Start MySQL on test server
     Wait for MySQL to clean database transactions
     Check database integrity
@@ -138,7 +169,7 @@ def run_slave_backup():
         until:
         max number of retry attempts reached
 
-    Destroy temporary volume and original snapshot
+    Destroy temporary volumes and original snapshots
     Stop test server
     Send email with details of backup
 
@@ -149,9 +180,12 @@ def run_slave_backup():
     start_time_dt = datetime.now()
     log(syslog.LOG_INFO, "Start backup of db slave")
 
-    conn = EC2Connection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+    conn = ThrottledEC2Connection(AWS_ACCESS_KEY_ID,
+                                  AWS_SECRET_ACCESS_KEY)
 
     log(syslog.LOG_INFO, "Connection to AWS: %s" % conn)
+    live_volume_ids = configured_volume_ids(LIVE_MYSQL_VOLUME_IDS,
+                                            LIVE_MYSQL_VOLUME_ID)
     cleanup_server(force=True)
     database_ok = False
 
@@ -160,33 +194,48 @@ def run_slave_backup():
         start_time = time.localtime()
 
         log(syslog.LOG_INFO, "Taking snapshot")
-        original_snapshot = get_live_snapshot(conn)
-        test_volume = create_volume(conn, original_snapshot)
-
-        log(syslog.LOG_INFO, "Mounting volume")
-        sudo('/bin/mount %s /home/volume' % MOUNT_DEVICE)
-        mysql_start = sudo('start mysql')
-
-        # Test integrity
-        if mysql_start.succeeded:
-            database_ok, snapshot_details = test_db_repaired(start_time)
-
-            log(syslog.LOG_INFO, "Database ok?: %s" % database_ok)
-            if database_ok:
-                description = GOOD_SNAPSHOT_DESCR + time.strftime(TIME_STR,
-                                                                  start_time)
-                repaired_snapshot = test_volume.create_snapshot(description)
-                repaired_snapshot.add_tag("Name", "db_slave: %s" %
-                                          time.strftime("%Y-%m-%d"))
-
-        else:
-            log(syslog.LOG_ERR, "MySQL failed to start")
-            database_ok = False
-
-        # cleanup - unmount drive and delete volume
-        cleanup_server()
-        destroy_volume(test_volume)
-        original_snapshot.delete()
+        original_snapshots, snapshot_progress = get_live_snapshot(conn,
+                live_volume_ids)
+
+        try:
+            test_volumes, mount_device = restore_snapshot_group(conn,
+                    original_snapshots)
+
+            try:
+                log(syslog.LOG_INFO, "Mounting volume")
+                sudo('/bin/mount %s /home/volume' % mount_device)
+                mysql_start = sudo('start mysql')
+
+                # Test integrity
+                if mysql_start.succeeded:
+                    database_ok, snapshot_details = \
+                            test_db_repaired(start_time)
+
+                    log(syslog.LOG_INFO, "Database ok?: %s" % database_ok)
+                    if database_ok:
+                        description = GOOD_SNAPSHOT_DESCR + \
+                                time.strftime(TIME_STR, start_time)
+                        repaired_snapshots, _ = snapshot_group(conn,
+                                [volume.id for volume in test_volumes],
+                                description,
+                                name="db_slave: %s" %
+                                        time.strftime("%Y-%m-%d"),
+                                freeze_path='/home/volume', wait=False)
+
+                else:
+                    log(syslog.LOG_ERR, "MySQL failed to start")
+                    database_ok = False
+
+            finally:
+                # cleanup - unmount drive and delete volume
+                cleanup_server()
+                run_parallel(destroy_volume,
+                             [(volume,) for volume in test_volumes])
+
+        finally:
+            # Temporary snapshots are always deleted, even if restore fails
+            for snapshot in original_snapshots:
+                snapshot.delete()
 
         if database_ok:
             break
@@ -199,7 +248,7 @@ def run_slave_backup():
 
     duration = datetime.now() - start_time_dt
     details = {
-        'live_db_id': LIVE_MYSQL_VOLUME_ID,
+        'live_db_id': ', '.join(live_volume_ids),
         'success': database_ok,
         'start_time': start_time_dt.strftime(TIME_STR),
         'duration': "%s:%s" % (duration.seconds / 60, duration.seconds % 60),
@@ -208,7 +257,10 @@ def run_slave_backup():
         }
 
     if database_ok:
-        details['snapshot_id'] = repaired_snapshot.id
+        details['snapshot_id'] = ', '.join([snapshot.id for snapshot in
+                                            repaired_snapshots])
+        details['snapshot_progress'] = format_snapshot_progress(
+                snapshot_progress)
         details.update(snapshot_details)
 
     return details
@@ -217,7 +269,8 @@ def start_backup_server():
     # fabric requires a seperate method to dynamically set env.hosts
     try:
         log(syslog.LOG_INFO, "Connect to Backup Server")
-        conn = EC2Connection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+        conn = ThrottledEC2Connection(AWS_ACCESS_KEY_ID,
+                                      AWS_SECRET_ACCESS_KEY)
         conn.start_instances([BACKUP_SERVER_INSTANCE])
 
         instance_list = conn.get_all_instances([BACKUP_SERVER_INSTANCE])
@@ -233,7 +286,7 @@ def start_backup_server():
         return instance.public_dns_name
 
     except:
-        log(syslog.LOG_ERR, traceback.print_exc())
+        log(syslog.LOG_ERR, traceback.format_exc())
         return None
 
 @roles(['logs'])
@@ -242,13 +295,12 @@ def run_logs_backup():
     start_time = datetime.now()
 
     # Check the logs are updating and current
-    with settings(
-        hide('warnings', 'running', 'stdout', 'stderr')
-    ):
-        result = sudo("tail -n 2 %s" % LOGS_FILE_PATH)
-    search = re.search(LOGS_TIME_REGEX, result)
+    log_times = scan_log_freshness(LOGS_FILE_PATH)
+    for path, log_time in sorted(log_times.items()):
+        log(syslog.LOG_INFO, "Newest time stamp in %s: %s" % (path, log_time))
 
-    if search is None:
+    found_times = [t for t in log_times.values() if t is not None]
+    if not found_times:
         log(syslog.LOG_ERR, "Could not find log file with matching time stamp")
         details = {
                     "success": False,
@@ -256,74 +308,438 @@ def run_logs_backup():
                   }
         return details
 
-    match_str = search.group(1)
-    last_log = datetime.strptime(match_str, LOGS_TIME_STR)
-    log_ok = (datetime.now() - last_log).seconds < MAX_LOGS_DELAY
-
-    log_ok = True
+    last_log = max(found_times)
+    log_delay = datetime.utcnow() - last_log
+    log_ok = log_delay.days * 86400 + log_delay.seconds < MAX_LOGS_DELAY
 
     if not log_ok:
-        log(syslog.LOG_ERR, "last time stamp found was too old: %s" % match_str)
+        log(syslog.LOG_ERR, "last time stamp found was too old: %s" % last_log)
         details = {
                     "success": False,
                     'syslog': syslog_output,
                   }
         return details
 
-    conn = EC2Connection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
-    volume = conn.get_all_volumes([LOGS_VOLUME_ID])[0]
+    conn = ThrottledEC2Connection(AWS_ACCESS_KEY_ID,
+                                  AWS_SECRET_ACCESS_KEY)
 
     log(syslog.LOG_INFO, "Creating snapshot of logs volume")
     description = LOGS_SNAPSHOT_PREFIX + time.strftime('%Y-%m-%d')
-    snapshot = volume.create_snapshot(description)
-    time.sleep(3)
+    logs_volume_ids = configured_volume_ids(LOGS_VOLUME_IDS, LOGS_VOLUME_ID)
+    snapshots, snapshot_progress = snapshot_group(conn, logs_volume_ids,
+                                                  description,
+                                                  freeze_path=LOGS_MOUNT)
     duration = datetime.now() - start_time
 
     details = {
-        'logs_volume_id': LOGS_VOLUME_ID,
-        'snapshot_id': snapshot.id,
+        'logs_volume_id': ', '.join(logs_volume_ids),
+        'snapshot_id': ', '.join([snapshot.id for snapshot in snapshots]),
         'success': True,
         'duration': "%s:%s" % (duration.seconds / 60, duration.seconds % 60),
         'latest_log_time': last_log,
+        'snapshot_progress': format_snapshot_progress(snapshot_progress),
         }
 
     return details
 
+def scan_log_freshness(path_glob):
+    """Find the newest time stamp (UTC) in each log file matching path_glob
+
+    A single tail reads the final LOGS_TAIL_BYTES of every file, seeking
+    from EOF, so large logs aren't read in full. Files without a time stamp
+    in their final block map to None.
+
+    Only the $time_local field of each line is used, as other bracketed
+    dates come from client supplied fields. The first line of a block is
+    skipped unless the whole file was read, as it starts mid line. Time
+    stamps that don't parse or are in the future are skipped.
+    """
+    with settings(
+        hide('warnings', 'running', 'stdout', 'stderr'),
+        warn_only=True
+    ):
+        result = sudo("tail -v -c %d %s" % (LOGS_TAIL_BYTES, path_glob))
+
+    # Split the output into the lines of each file's block
+    blocks = {}
+    path = None
+    for line in result.splitlines():
+        header = LOGS_HEADER_REGEX.match(line)
+        if header:
+            path = header.group(1)
+            blocks[path] = []
+        elif path is not None:
+            blocks[path].append(line)
+
+    latest_allowed = datetime.utcnow() + timedelta(seconds=LOGS_CLOCK_SKEW)
+    log_times = {}
+    for path, lines in blocks.items():
+        log_times[path] = None
+
+        # A file smaller than the block was read whole
+        if len('\n'.join(lines)) + 1 >= LOGS_TAIL_BYTES:
+            lines = lines[1:]
+
+        for line in lines:
+            match = LOGS_TIME_REGEX.match(line)
+            if match is None:
+                continue
+
+            log_time = parse_log_time(match)
+            if log_time is None or log_time > latest_allowed:
+                continue
+
+            if log_times[path] is None or log_time > log_times[path]:
+                log_times[path] = log_time
+
+    return log_times
+
+def parse_log_time(match):
+    """Convert a LOGS_TIME_REGEX match to a UTC datetime, avoiding strptime
+
+    Returns None if the match isn't a valid date.
+    """
+    day, month, year, hour, minute, second, sign, tz_hour, tz_minute = \
+            match.groups()
+    try:
+        log_time = datetime(int(year), LOGS_MONTHS[month], int(day),
+                            int(hour), int(minute), int(second))
+    except (KeyError, ValueError):
+        return None
+    offset = timedelta(hours=int(tz_hour), minutes=int(tz_minute))
+
+    if sign == '+':
+        return log_time - offset
+    return log_time + offset
+
 ###########################
 
-def get_live_snapshot(conn):
-    # Attach to live MySQL volume
-    live_volume = conn.get_all_volumes(volume_ids=[LIVE_MYSQL_VOLUME_ID])[0]
-    snapshot = live_volume.create_snapshot(description=TMP_SNAPSHOT_DESCR)
+def configured_volume_ids(volume_ids, volume_id):
+    """Volume ids from a *_VOLUME_IDS setting, falling back to the single
+    *_VOLUME_ID one
+    """
+    if volume_ids:
+        return list(volume_ids)
+    if volume_id:
+        return [volume_id]
+    raise Exception("No volume ids configured")
+
+def get_live_snapshot(conn, volume_ids):
+    # Snapshot every live MySQL volume as one group
+    log(syslog.LOG_INFO, 'Creating snapshot from volumes: %s' %
+        ', '.join(volume_ids))
+
+    freeze_path = LIVE_MYSQL_MOUNT if LIVE_MYSQL_HOST else None
+    snapshots, _ = snapshot_group(conn, volume_ids,
+                                  TMP_SNAPSHOT_DESCR,
+                                  freeze_host=LIVE_MYSQL_HOST,
+                                  freeze_path=freeze_path, wait=False)
+
+    try:
+        return snapshots, monitor_snapshots(conn, snapshots)
+    except:
+        # Don't leave temporary snapshots behind when they fail or stall
+        log(syslog.LOG_ERR, 'Deleting temporary snapshots: %s' %
+            ', '.join([snapshot.id for snapshot in snapshots]))
+        for snapshot in snapshots:
+            snapshot.delete()
+        raise
+
+def snapshot_group(conn, volume_ids, description, name=None, freeze_host=None,
+                   freeze_path=None, wait=True):
+    """Snapshot volume_ids as one consistent group
+
+    The filesystem at freeze_path (on freeze_host, or the current host) is
+    frozen once while all snapshots are issued concurrently, then every
+    snapshot is tagged with a shared group id. Returns the snapshots, in
+    volume_ids order, and their progress once the group completes.
+
+    A group of more than one volume must have a freeze_path. Throttled
+    creates are retried until FREEZE_TIMEOUT seconds after freezing; the
+    filesystem is then thawed even if snapshots are still being issued, any
+    that were created are deleted and the group fails.
+    """
+    if not volume_ids:
+        raise Exception("No volumes to snapshot")
+    if len(volume_ids) > 1 and not freeze_path:
+        raise Exception("Snapshot group of %s needs a filesystem to freeze" %
+                        ', '.join(volume_ids))
+
+    group_id = "%s-%s" % (volume_ids[0], time.strftime('%Y%m%d%H%M%S'))
+    frozen = bool(freeze_path)
+    deadline = None
+
+    if frozen:
+        freeze_filesystem(freeze_host, freeze_path, True)
+        deadline = time.time() + FREEZE_TIMEOUT
+
+    try:
+        creating = ParallelCalls(create_group_snapshot,
+                                 [(volume_id, description, deadline)
+                                  for volume_id in volume_ids])
+        issued = creating.join(FREEZE_TIMEOUT if frozen else None)
+    finally:
+        if frozen:
+            freeze_filesystem(freeze_host, freeze_path, False)
+
+    if not issued:
+        log(syslog.LOG_ERR, 'Snapshot group %s not issued within %d seconds '
+            'of freezing' % (group_id, FREEZE_TIMEOUT))
+        creating.join()
+
+    try:
+        if not issued:
+            raise Exception("Snapshot group %s timed out while frozen" %
+                            group_id)
+        snapshots = creating.get_results()
+    except:
+        for snapshot in creating.completed():
+            snapshot.delete()
+        raise
+
+    tags = {'SnapshotGroup': group_id}
+    if name:
+        tags['Name'] = name
+    conn.create_tags([snapshot.id for snapshot in snapshots], tags)
+    log(syslog.LOG_INFO, 'Snapshot group %s: %s' % (group_id,
+        ', '.join([snapshot.id for snapshot in snapshots])))
+
+    if not wait:
+        return snapshots, {}
+    return snapshots, monitor_snapshots(conn, snapshots)
+
+def create_group_snapshot(volume_id, description, deadline):
+    # boto connections aren't thread safe, so each thread gets its own
+    conn = ThrottledEC2Connection(AWS_ACCESS_KEY_ID,
+                                  AWS_SECRET_ACCESS_KEY)
+    # Don't back off past the point the filesystem has to be thawed
+    conn.deadline = deadline
+    return conn.create_snapshot(volume_id, description)
+
+def freeze_filesystem(host, path, freeze):
+    """Freeze (or thaw) the filesystem at path, on host if given
+    """
+    host_string = host or env.host_string
+    with settings(
+        hide('warnings', 'running', 'stdout', 'stderr'),
+        host_string=host_string
+    ):
+        sudo('fsfreeze %s %s' % ('-f' if freeze else '-u', path))
+
+    log(syslog.LOG_INFO, '%s %s on %s' % ('Froze' if freeze else 'Thawed',
+                                          path, host_string))
 
-    log(syslog.LOG_INFO,
-        'Creating snapshot from volume: %s' % LIVE_MYSQL_VOLUME_ID)
+def restore_snapshot_group(conn, snapshots):
+    """Create and attach a volume from each snapshot, in parallel
 
-    wait_for_aws(snapshot, "pending")
-    return snapshot
+    Returns the volumes and the device to mount. A multi-volume group is
+    assembled into RAID_DEVICE first.
+    """
+    if len(snapshots) == 1:
+        return [create_volume(conn, snapshots[0])], MOUNT_DEVICE
 
-def create_volume(conn, snapshot_name):
-    snapshot_volume =  conn.create_volume(TMP_VOL_SIZE, ZONE, snapshot_name)
+    if len(snapshots) > len(MOUNT_POINTS):
+        raise Exception("Not enough MOUNT_POINTS for %d volumes" %
+                        len(snapshots))
+    mount_points = MOUNT_POINTS[:len(snapshots)]
+
+    # Detach anything left over up front, so the threads only make EC2 calls
+    cleanup_server(force=True)
+    detach_old_volumes(conn, mount_points)
+
+    log(syslog.LOG_INFO, 'Creating test volumes at %s' %
+        ', '.join(mount_points))
+    creating = ParallelCalls(create_group_volume, zip(snapshots, mount_points))
+    creating.join()
+
+    try:
+        volumes = creating.get_results()
+        time.sleep(10)     # appears to be required to attach drive reliably
+
+        log(syslog.LOG_INFO, 'Assembling %s' % RAID_DEVICE)
+        partitions = ['%s1' % mount_point for mount_point in mount_points]
+        sudo('mdadm --assemble %s %s' % (RAID_DEVICE, ' '.join(partitions)))
+    except:
+        # Don't leave the members that were restored attached, or they
+        # pile up as detached volumes on later runs
+        log(syslog.LOG_ERR, 'Restore failed, destroying test volumes')
+        cleanup_server(force=True)
+        run_parallel(destroy_volume,
+                     [(volume,) for volume in creating.completed()])
+        raise
+
+    return volumes, RAID_DEVICE
+
+def create_group_volume(snapshot, mount_point):
+    # boto connections aren't thread safe, so each thread gets its own
+    conn = ThrottledEC2Connection(AWS_ACCESS_KEY_ID,
+                                  AWS_SECRET_ACCESS_KEY)
+    volume = new_volume(conn, snapshot)
+    try:
+        volume.attach(BACKUP_SERVER_INSTANCE, mount_point)
+        wait_for_aws(volume, "available")
+    except:
+        # Not returned, so the caller can't clean it up
+        volume.delete()
+        raise
+    return volume
+
+class ParallelCalls(object):
+    """Call func with each tuple of args in its own thread
+
+    Only make EC2 calls from func: fabric's env and connections aren't
+    thread safe, so remote commands stay on the main thread.
+    """
+
+    def __init__(self, func, args_list):
+        self.func = func
+        self.results = [None] * len(args_list)
+        self.errors = []
+        self.threads = [threading.Thread(target=self.worker, args=(i, args))
+                        for i, args in enumerate(args_list)]
+        for thread in self.threads:
+            thread.start()
+
+    def worker(self, i, args):
+        try:
+            self.results[i] = self.func(*args)
+        except:
+            self.errors.append(sys.exc_info())
+
+    def join(self, timeout=None):
+        """Wait up to timeout seconds (or forever) for every call, returning
+        whether they all finished
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.threads:
+            if deadline is None:
+                thread.join()
+            else:
+                thread.join(max(0, deadline - time.time()))
+        return not [thread for thread in self.threads if thread.is_alive()]
+
+    def completed(self):
+        return [result for result in self.results if result is not None]
+
+    def get_results(self):
+        """Return the results in order, re-raising the first exception if
+        any call failed
+        """
+        if self.errors:
+            exc_type, exc_value, exc_traceback = self.errors[0]
+            raise exc_type, exc_value, exc_traceback
+        return self.results
+
+def run_parallel(func, args_list):
+    calls = ParallelCalls(func, args_list)
+    calls.join()
+    return calls.get_results()
+
+def monitor_snapshots(conn, snapshots, stall_timeout=SNAPSHOT_STALL_TIMEOUT):
+    """Poll snapshots until they complete, logging throughput and ETA
+
+    All snapshots are described in a single request per poll. Raises if a
+    snapshot errors, or its progress doesn't move within stall_timeout.
+    Returns a dict of snapshot id -> progress details, as first seen
+    completed, so members that finish early keep their own throughput.
+    """
+    snapshot_ids = [snapshot.id for snapshot in snapshots]
+    start = time.time()
+    # snapshot id -> (last percent seen, time it last changed)
+    last_change = dict((s_id, (None, start)) for s_id in snapshot_ids)
+    progress = {}
+
+    while True:
+        now = time.time()
+        pending = False
+
+        for snapshot in conn.get_all_snapshots(snapshot_ids=snapshot_ids):
+            if snapshot.id in progress and \
+                    progress[snapshot.id]['status'] != 'pending':
+                continue
+
+            details = get_snapshot_progress(snapshot, now - start)
+            progress[snapshot.id] = details
+
+            log(syslog.LOG_INFO, 'Snapshot %(snapshot_id)s: %(percent)s%% '
+                '%(throughput)s, ETA %(eta)s' % details)
+
+            if snapshot.status == 'error':
+                raise Exception("Snapshot %s failed" % snapshot.id)
+
+            if snapshot.status != 'pending':
+                continue
+            pending = True
+
+            last_percent, changed_at = last_change[snapshot.id]
+            if details['percent'] != last_percent:
+                last_change[snapshot.id] = (details['percent'], now)
+            elif now - changed_at > stall_timeout:
+                raise Exception("Snapshot %s stalled at %s%% for %d seconds" %
+                                (snapshot.id, last_percent, now - changed_at))
+
+        if not pending:
+            return progress
+
+        time.sleep(SNAPSHOT_POLL_INTERVAL)
+
+def get_snapshot_progress(snapshot, elapsed):
+    """Work out throughput (GB/min) and ETA of a snapshot after elapsed seconds
+    """
+    try:
+        percent = int(snapshot.progress.rstrip('%'))
+    except (AttributeError, ValueError):
+        percent = 0
+    if snapshot.status == 'completed':
+        percent = 100
+
+    size = float(snapshot.volume_size or 0)
+    done = size * percent / 100
+    minutes = elapsed / 60
+
+    throughput = done / minutes if elapsed >= MIN_THROUGHPUT_ELAPSED else 0.0
+    if throughput:
+        throughput_str = "%.2f GB/min" % throughput
+        eta = int((size - done) / throughput * 60)
+        eta_str = "%s:%02d" % (eta / 60, eta % 60)
+    else:
+        throughput_str = "n/a"
+        eta_str = "unknown"
+
+    return {
+        'snapshot_id': snapshot.id,
+        'status': snapshot.status,
+        'percent': percent,
+        'throughput': throughput_str,
+        'eta': eta_str,
+        'elapsed': "%s:%02d" % (int(elapsed) / 60, int(elapsed) % 60),
+        }
+
+def format_snapshot_progress(progress):
+    return ', '.join(['%(snapshot_id)s %(throughput)s in %(elapsed)s' %
+                      details for details in progress.values()])
+
+def new_volume(conn, snapshot):
+    size = max(TMP_VOL_SIZE, int(snapshot.volume_size or 0))
+    volume = conn.create_volume(size, ZONE, snapshot)
+    wait_for_aws(volume, "creating")
+    return volume
+
+def create_volume(conn, snapshot, mount_point=MOUNT_POINT):
     log(syslog.LOG_INFO, 'Creating test volume')
-    wait_for_aws(snapshot_volume, "creating")
+    snapshot_volume = new_volume(conn, snapshot)
 
     try:
-        snapshot_volume.attach(BACKUP_SERVER_INSTANCE, MOUNT_POINT)
+        snapshot_volume.attach(BACKUP_SERVER_INSTANCE, mount_point)
     except:
-        log(syslog.LOG_INFO, 'Old volume found mounted at %s' % MOUNT_POINT)
+        log(syslog.LOG_INFO, 'Old volume found mounted at %s' % mount_point)
 
         # If the script didn't shutdown cleanly, an old snapshot may still
         # be attached. Attempt to detach it.
         cleanup_server(force=True)
-
-        volumes = [v for v in conn.get_all_volumes() \
-            if v.attach_data.instance_id == BACKUP_SERVER_INSTANCE]
-        for volume in volumes:
-            if volume.attach_data.device == MOUNT_POINT:
-                volume.detach(BACKUP_SERVER_INSTANCE)
-                wait_for_aws(volume, "in-use")
-                snapshot_volume.attach(BACKUP_SERVER_INSTANCE, MOUNT_POINT)
-                snapshot_volume.update()
+        detach_old_volumes(conn, [mount_point])
+        snapshot_volume.attach(BACKUP_SERVER_INSTANCE, mount_point)
+        snapshot_volume.update()
 
     log(syslog.LOG_INFO, 'Attaching %s' % snapshot_volume)
     wait_for_aws(snapshot_volume, "available")
@@ -331,6 +747,14 @@ def create_volume(conn, snapshot_name):
 
     return snapshot_volume
 
+def detach_old_volumes(conn, mount_points):
+    volumes = [v for v in conn.get_all_volumes() \
+        if v.attach_data.instance_id == BACKUP_SERVER_INSTANCE]
+    for volume in volumes:
+        if volume.attach_data.device in mount_points:
+            volume.detach(BACKUP_SERVER_INSTANCE)
+            wait_for_aws(volume, "in-use")
+
 def destroy_volume(volume):
     volume.detach(BACKUP_SERVER_INSTANCE)
     wait_for_aws(volume, "in-use")
@@ -432,6 +856,8 @@ def cleanup_server(force=False):
             sudo('pkill -9 -f mysqld')
         sudo('stop mysql')
         sudo('/bin/umount %s' % MOUNT_DEVICE)
+        sudo('/bin/umount %s' % RAID_DEVICE)
+        sudo('mdadm --stop %s' % RAID_DEVICE)
 
 def send_report_email(start_time, db_slave, logs):
 
@@ -450,6 +876,13 @@ def send_report_email(start_time, db_slave, logs):
 
         """ % summary
 
+    if 'stop_error' in db_slave:
+        email_text += """
+        Backup server failed to stop, it may still be running
+        -------
+        %(stop_error)s
+        """ % db_slave
+
     if db_slave['success']:
         email_text += """
         DB Slave Details
@@ -457,6 +890,7 @@ def send_report_email(start_time, db_slave, logs):
         Live DB Volume ID: \t\t%(live_db_id)s
         Backup snapshot id: \t\t%(snapshot_id)s
         Duration: \t\t\t\t%(duration)s
+        Snapshot progress: \t\t%(snapshot_progress)s
         Newest user signup time: \t%(newest_user_time)s
         """ % db_slave
 
@@ -467,6 +901,7 @@ def send_report_email(start_time, db_slave, logs):
         Logs Volume ID: \t\t %(logs_volume_id)s
         Backup snapshot id: \t\t%(snapshot_id)s
         Duration: \t\t\t\t%(duration)s
+        Snapshot progress: \t\t%(snapshot_progress)s
         Latest log time: \t\t  %(latest_log_time)s
         """ % logs
 
@@ -482,6 +917,12 @@ def send_report_email(start_time, db_slave, logs):
         """
         email_text += report_error(logs)
 
+    email_text += """
+        EC2 API calls
+        -------
+        """
+    email_text += format_metrics()
+
     # Remove leading tabs from string
     content = ''
     for line in email_text.split('\n'):
@@ -541,10 +982,14 @@ def report_error(details):
 # A global containing output to log
 syslog_output = ""
 
+# Guards syslog_output, as log() may be called from several threads
+syslog_lock = threading.Lock()
+
 def log(level, msg):
     global syslog_output
     out_msg = LOG_PREFIX + ": " + msg
 
     syslog.syslog(level, out_msg)
-    syslog_output = '\n'.join([syslog_output, out_msg])
+    with syslog_lock:
+        syslog_output = '\n'.join([syslog_output, out_msg])
 
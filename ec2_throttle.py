@@ -0,0 +1,251 @@
+# Rate limiting, retries and request coalescing for EC2 API calls
+
+import copy
+import time
+import random
+import socket
+import httplib
+import threading
+
+from boto.ec2.connection import EC2Connection
+from boto.exception import BotoServerError
+
+######################################
+# Token bucket per API action: (requests per second, burst)
+DEFAULT_RATE_LIMIT = (5, 10)
+RATE_LIMITS = {'DescribeSnapshots': (2, 5),
+               'DescribeVolumes': (2, 5),
+               'DescribeInstances': (2, 5),
+               'CreateSnapshot': (2, 5),
+               'CreateVolume': (2, 5),
+              }
+
+MAX_RETRIES = 6
+BACKOFF_BASE = 0.5 # Seconds, doubled on each retry
+BACKOFF_MAX = 30
+
+THROTTLE_ERRORS = ['RequestLimitExceeded', 'Throttling']
+TRANSIENT_ERRORS = ['InternalError', 'Unavailable', 'ServiceUnavailable']
+
+# Only these are coalesced: their results are flat lists of objects that can
+# be rebound to the caller's connection
+COALESCED_ACTIONS = ['DescribeSnapshots', 'DescribeVolumes']
+
+######################################
+
+class TokenBucket(object):
+    """Allow rate requests per second on average, with bursts up to burst
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, blocking until one is available
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+class InFlight(object):
+    """A describe request other threads can wait on for its result
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# Shared by every connection, so concurrent threads each using their own
+# connection are still limited and coalesced together
+_lock = threading.Lock()
+_buckets = {}
+_in_flight = {}
+_metrics = {}
+
+def get_bucket(action):
+    with _lock:
+        if action not in _buckets:
+            rate, burst = RATE_LIMITS.get(action, DEFAULT_RATE_LIMIT)
+            _buckets[action] = TokenBucket(rate, burst)
+        return _buckets[action]
+
+def count(action, metric):
+    with _lock:
+        counts = _metrics.setdefault(action, {'calls': 0, 'throttled': 0,
+                                              'retries': 0, 'coalesced': 0})
+        counts[metric] += 1
+
+def metrics():
+    """Return a copy of action -> calls, throttled, retries, coalesced counts
+    """
+    with _lock:
+        return dict((action, dict(counts))
+                    for action, counts in _metrics.items())
+
+def format_metrics():
+    return '\n'.join(['%s: %d calls, %d throttled, %d retries, %d coalesced' %
+                      (action, counts['calls'], counts['throttled'],
+                       counts['retries'], counts['coalesced'])
+                      for action, counts in sorted(metrics().items())])
+
+def is_throttled(error):
+    return isinstance(error, BotoServerError) and \
+            error.error_code in THROTTLE_ERRORS
+
+def is_retryable(action, error):
+    """Throttled requests are rejected without being run, so are always safe
+    to retry. Other transient errors are only retried for read-only Describe
+    actions.
+
+    So a create (CreateVolume, CreateSnapshot, ...) is only ever resent
+    after a RequestLimitExceeded or Throttling response, never after a 5xx
+    or socket error, where it may have gone through.
+    """
+    if is_throttled(error):
+        return True
+
+    if not action.startswith('Describe'):
+        return False
+
+    if isinstance(error, BotoServerError):
+        return error.error_code in TRANSIENT_ERRORS or error.status >= 500
+    return isinstance(error, (socket.error, httplib.HTTPException))
+
+def call_with_retry(action, max_retries, deadline, func, *args, **kwargs):
+    """Call func, rate limited by action, retrying throttling and transient
+    errors with exponential backoff up to max_retries times
+
+    If deadline (epoch seconds) is given, gives up rather than back off past
+    it.
+    """
+    bucket = get_bucket(action)
+
+    for attempt in range(max_retries + 1):
+        bucket.acquire()
+        count(action, 'calls')
+        try:
+            return func(*args, **kwargs)
+        except Exception, e:
+            if is_throttled(e):
+                count(action, 'throttled')
+
+            if attempt == max_retries or not is_retryable(action, e):
+                raise
+
+            # Full jitter, so retrying threads don't stay in step
+            delay = random.uniform(0, min(BACKOFF_MAX,
+                                          BACKOFF_BASE * 2 ** attempt))
+            if deadline is not None and time.time() + delay >= deadline:
+                raise
+
+            count(action, 'retries')
+            time.sleep(delay)
+
+def call_coalesced(action, params, max_retries, deadline, func,
+                   *args, **kwargs):
+    """Call func once for identical concurrent describe requests, sharing its
+    result with every caller that arrives while it is in flight
+
+    Returns the result, and whether it was shared from another caller.
+    """
+    key = (action, tuple(sorted(params.items())))
+
+    with _lock:
+        request = _in_flight.get(key)
+        leader = request is None
+        if leader:
+            request = _in_flight[key] = InFlight()
+
+    if not leader:
+        count(action, 'coalesced')
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result, True
+
+    try:
+        request.result = call_with_retry(action, max_retries, deadline, func,
+                                         *args, **kwargs)
+        return request.result, False
+    except Exception, e:
+        request.error = e
+        raise
+    finally:
+        with _lock:
+            del _in_flight[key]
+        request.done.set()
+
+class ThrottledEC2Connection(EC2Connection):
+    """EC2Connection with every API call rate limited and retried
+
+    Objects returned (volumes, snapshots, ...) keep this connection, so
+    their update() polls are limited too. Identical COALESCED_ACTIONS
+    requests made concurrently are coalesced into one call.
+
+    boto's own retries are turned off, so this is the only retry loop.
+    Set max_retries to 0 to fail on the first error, or deadline (epoch
+    seconds) to stop backing off once it would be passed.
+    """
+
+    max_retries = MAX_RETRIES
+    deadline = None
+
+    def _mexe(self, *args, **kwargs):
+        # boto retries 5xx responses, including throttling, itself; that
+        # would bypass the rate limit, the metrics and the create rules
+        kwargs['override_num_retries'] = 0
+        return super(ThrottledEC2Connection, self)._mexe(*args, **kwargs)
+
+    def get_list(self, action, params, *args, **kwargs):
+        func = super(ThrottledEC2Connection, self).get_list
+        return self.throttled_call(action, params, func,
+                                   action in COALESCED_ACTIONS,
+                                   *args, **kwargs)
+
+    def get_object(self, action, params, *args, **kwargs):
+        func = super(ThrottledEC2Connection, self).get_object
+        return self.throttled_call(action, params, func, False,
+                                   *args, **kwargs)
+
+    def get_status(self, action, params, *args, **kwargs):
+        func = super(ThrottledEC2Connection, self).get_status
+        return self.throttled_call(action, params, func, False,
+                                   *args, **kwargs)
+
+    def throttled_call(self, action, params, func, coalesce, *args, **kwargs):
+        if not coalesce:
+            return call_with_retry(action, self.max_retries, self.deadline,
+                                   func, action, params, *args, **kwargs)
+
+        result, shared = call_coalesced(action, params, self.max_retries,
+                                        self.deadline, func, action, params,
+                                        *args, **kwargs)
+        if shared:
+            result = self.rebind(result)
+        return result
+
+    def rebind(self, result):
+        """Copy a result shared from another connection, so its objects use
+        this connection for later calls such as update()
+        """
+        result = copy.copy(result)
+        for i, item in enumerate(result):
+            item = copy.copy(item)
+            item.connection = self
+            result[i] = item
+        return result